@@ -1,6 +1,7 @@
 import argparse
 import logging
 import math
+import threading
 import os
 import pickle
 import random
@@ -19,7 +20,6 @@ from huggingface_hub import Repository
 from transformers import (
     CONFIG_MAPPING,
     MODEL_MAPPING,
-    AdamW,
     AutoConfig,
     AutoModelForQuestionAnswering,
     AutoTokenizer,
@@ -63,7 +63,9 @@ class ReverseSqrtScheduler:
         self._optimizer.step()
 
     def zero_grad(self):
-        self._optimizer.zero_grad()
+        # setting grads to None skips a full memset over the parameters; the next
+        # backward allocates fresh buffers and AdamW simply skips None grads
+        self._optimizer.zero_grad(set_to_none=True)
 
     def _update_learning_rate(self):
         self.n_steps += 1
@@ -76,6 +78,45 @@ class ReverseSqrtScheduler:
             param_group['lr'] = lr[i]
 
 
+class InBackwardOptimizerFacade:
+    """Stands in for the optimizer when --optimizer_in_backward is used.
+
+    The real AdamW updates run inside per-parameter gradient hooks during backward, so
+    step() and zero_grad() are no-ops here; the facade only exposes two param_groups
+    whose 'lr' writes fan out to every underlying hook optimizer. Because the updates
+    fire during backward, the training loop must call scheduler.step_and_update_lr()
+    BEFORE accelerator.backward() in this mode — writing the LRs afterwards would make
+    every update lag the schedule by one step.
+    """
+
+    class _FanoutGroup(dict):
+        def __init__(self, groups):
+            super().__init__(lr=groups[0]['lr'] if groups else 0.0)
+            self._groups = groups
+
+        def __setitem__(self, key, value):
+            super().__setitem__(key, value)
+            for group in self._groups:
+                group[key] = value
+
+    def __init__(self, *param_lists):
+        self.param_groups = [
+            self._FanoutGroup([
+                group
+                for param in params
+                for opt in getattr(param, "_in_backward_optimizers", [])
+                for group in opt.param_groups
+            ])
+            for params in param_lists
+        ]
+
+    def step(self):
+        pass
+
+    def zero_grad(self, set_to_none=True):
+        pass
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Finetune a transformers model on a Question Answering task")
     parser.add_argument('--ratio', required=True, type=int)
@@ -175,6 +216,20 @@ def parse_args():
         default=1,
         help="Number of updates steps to accumulate before performing a backward/update pass.",
     )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="bf16",
+        choices=["no", "fp16", "bf16"],
+        help="Mixed precision mode handed to the Accelerator; bf16 halves activation"
+             " bandwidth on Ampere+ without needing a grad scaler.",
+    )
+    parser.add_argument(
+        "--optimizer_in_backward",
+        action="store_true",
+        help="Run the AdamW update inside the gradient hooks during backward (experimental;"
+             " incompatible with gradient accumulation).",
+    )
     parser.add_argument(
         "--lr_scheduler_type",
         type=SchedulerType,
@@ -269,6 +324,13 @@ def parse_args():
         if args.test_file is not None:
             extension = args.test_file.split(".")[-1]
             assert extension in ["csv", "json"], "`test_file` should be a csv or a json file."
+    if args.optimizer_in_backward:
+        # the gradient hooks update on every micro-batch and bypass accelerate's
+        # prepared optimizer, so neither accumulation nor the fp16 grad scaler apply
+        if args.gradient_accumulation_steps > 1:
+            parser.error("--optimizer_in_backward is incompatible with --gradient_accumulation_steps > 1")
+        if args.mixed_precision == "fp16":
+            parser.error("--optimizer_in_backward cannot run under fp16: no grad scaler covers the in-backward updates")
     return args
 
 
@@ -288,7 +350,12 @@ def main():
     random_index = [0 for _ in range(args.ratio)] + [1 for _ in range(10 - args.ratio)]
     random.shuffle(random_index)
 
-    accelerator = Accelerator()
+    # accelerate wraps forward in autocast (and grad scaling for fp16) itself, so the
+    # training loop below stays precision-agnostic
+    accelerator = Accelerator(
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        mixed_precision=args.mixed_precision if torch.cuda.is_available() else "no",
+    )
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
         datefmt="%m/%d/%Y %H:%M:%S",
@@ -353,6 +420,12 @@ def main():
         logger.info("Training new model from scratch")
         model = AutoModelForQuestionAnswering.from_config(config)
 
+    # TorchInductor fuses the attention/LayerNorm pointwise tails and reduce-overhead
+    # replays the step through CUDA graphs. Shapes must stay static for the captured
+    # graphs to be reused, so run with --pad_to_max_length.
+    if hasattr(torch, "compile"):
+        model = torch.compile(model, mode="reduce-overhead", dynamic=False)
+
     # Preprocessing the datasets.
     # Preprocessing is slight different for training and evaluation.
 
@@ -519,23 +592,26 @@ def main():
         """
 
         step = 0
-        # create a numpy array and fill it with -100.
-        logits_concat = np.full((len(dataset), max_len), -100, dtype=np.float64)
-        # Now since we have create an array now we will populate it with the outputs gathered using accelerator.gather
-        for i, output_logit in enumerate(start_or_end_logits):  # populate columns
-            # We have to fill it such that we have to take the whole tensor and replace it on the newly created array
-            # And after every iteration we have to change the step
-
+        # The gathered logits are float32, so a float64 buffer only doubles the bytes
+        # moved. np.empty skips the upfront fill; instead only the unfilled tail of each
+        # row is set to -100, so every byte is written exactly once.
+        logits_concat = np.empty((len(dataset), max_len), dtype=np.float32)
+        # Only the final batch can overrun the dataset length (gather pads it up to a
+        # multiple of the world size), so the boundary handling is peeled out of the
+        # loop and the first batches take the branch-free fast path.
+        for output_logit in start_or_end_logits[:-1]:
             batch_size = output_logit.shape[0]
             cols = output_logit.shape[1]
-
-            if step + batch_size < len(dataset):
-                logits_concat[step: step + batch_size, :cols] = output_logit
-            else:
-                logits_concat[step:, :cols] = output_logit[: len(dataset) - step]
-
+            logits_concat[step: step + batch_size, :cols] = output_logit
+            logits_concat[step: step + batch_size, cols:] = -100
             step += batch_size
 
+        if start_or_end_logits:
+            last_logit = start_or_end_logits[-1]
+            cols = last_logit.shape[1]
+            logits_concat[step:, :cols] = last_logit[: len(dataset) - step]
+            logits_concat[step:, cols:] = -100
+
         return logits_concat
 
     # Optimizer
@@ -548,18 +624,48 @@ def main():
         else:
             finetune_params.append(p)
 
-    optimizer = AdamW(
-        [{'params': pretrained_params, 'lr': args.learning_rate_pre_train},
-         {'params': finetune_params, 'lr': args.learning_rate_fine_tune}])
-    scheduler = ReverseSqrtScheduler(optimizer, [args.learning_rate_pre_train, args.learning_rate_fine_tune],
-                                     args.num_warmup_steps)
-
+    if args.optimizer_in_backward:
+        # Fuse the AdamW update into backward itself: each parameter is updated by its
+        # gradient hook as soon as the grad is ready, overlapping the optimizer math
+        # with the rest of backward and freeing each grad immediately. Off by default
+        # because the hooks update on every micro-batch, bypassing accumulation.
+        from torch.distributed.optim import _apply_optimizer_in_backward
+
+        adamw_kwargs = {"fused": True} if torch.cuda.is_available() else {"foreach": True}
+        _apply_optimizer_in_backward(
+            torch.optim.AdamW, pretrained_params,
+            optimizer_kwargs={"lr": args.learning_rate_pre_train, **adamw_kwargs})
+        _apply_optimizer_in_backward(
+            torch.optim.AdamW, finetune_params,
+            optimizer_kwargs={"lr": args.learning_rate_fine_tune, **adamw_kwargs})
+        optimizer = InBackwardOptimizerFacade(pretrained_params, finetune_params)
+    else:
+        param_groups = [{'params': pretrained_params, 'lr': args.learning_rate_pre_train},
+                        {'params': finetune_params, 'lr': args.learning_rate_fine_tune}]
+        # the fused CUDA kernel updates every parameter in a single launch per dtype,
+        # instead of one launch per tensor; foreach is the multi-tensor fallback off-GPU
+        if torch.cuda.is_available():
+            optimizer = torch.optim.AdamW(param_groups, fused=True)
+        else:
+            optimizer = torch.optim.AdamW(param_groups, foreach=True)
     # Split weights in two groups, one with weight decay and the other not.
 
     # Prepare everything with our `accelerator`.
-    model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
-        model, optimizer, train_dataloader, eval_dataloader
-    )
+    if args.optimizer_in_backward:
+        # the facade is not a torch optimizer, so only the model and loaders go through
+        model, train_dataloader, eval_dataloader = accelerator.prepare(
+            model, train_dataloader, eval_dataloader
+        )
+    else:
+        model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
+            model, optimizer, train_dataloader, eval_dataloader
+        )
+
+    # The scheduler must drive the prepared optimizer: under fp16 it is the
+    # AcceleratedOptimizer wrapper that unscales the gradients before stepping, so
+    # stepping the raw AdamW would apply the ~2^16-scaled gradients directly.
+    scheduler = ReverseSqrtScheduler(optimizer, [args.learning_rate_pre_train, args.learning_rate_fine_tune],
+                                     args.num_warmup_steps)
 
     # Note -> the training dataloader needs to be prepared before we grab his length below (cause its length will be
     # shorter in multiprocess)
@@ -607,16 +713,29 @@ def main():
         prediction = post_processing_function(eval_examples, eval_dataset, outputs_numpy)
         eval_metric = metric.compute(predictions=prediction.predictions, references=prediction.label_ids)
         logger.info(f"Evaluation metrics: {eval_metric}")
-        with open(args.output_log_file, "a") as log_file_fr:
-            log_file_fr.write(f"eval:-------")
-            log_file_fr.write(f"\n Evaluation metrics: {eval_metric}")
-            log_file_fr.write(f"train:-----")
+        log_fp.write(f"eval:-------")
+        log_fp.write(f"\n Evaluation metrics: {eval_metric}")
+        log_fp.write(f"train:-----")
+        log_fp.flush()
 
         model.train()
         f = eval_metric["f1"]
 
         return f
 
+    def save_checkpoint(path):
+        # every process used to serialize its own copy of the weights; gather once on
+        # the main process and let a background thread hide the disk write behind the
+        # next training steps. get_state_dict returns the live parameter tensors, so
+        # the CPU snapshot has to be taken here, before training mutates them again;
+        # only the torch.save of the copy is deferred.
+        if accelerator.is_main_process:
+            state_dict = {
+                key: value.detach().to("cpu", copy=True)
+                for key, value in accelerator.get_state_dict(model).items()
+            }
+            threading.Thread(target=torch.save, args=(state_dict, path)).start()
+
     # Train!
     total_batch_size = args.per_device_train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
 
@@ -629,12 +748,36 @@ def main():
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
 
     # Only show the progress bar once on each machine.
-    progress_bar = tqdm(range(args.max_train_steps), disable=not accelerator.is_local_main_process)
+    # throttle refreshes so the bar costs roughly constant time per second instead of a
+    # stdout flush on every optimizer step
+    progress_bar = tqdm(
+        range(args.max_train_steps),
+        disable=not accelerator.is_local_main_process,
+        mininterval=1.0,
+        miniters=max(1, args.max_train_steps // 1000),
+    )
     completed_steps = 0
 
     os.makedirs(os.path.dirname(args.output_log_file), exist_ok=True)
-    with open(args.output_log_file, "w") as log_file_fr:
-        log_file_fr.write("start\n")
+    # one buffered handle for the whole run instead of an open/close pair per log line,
+    # which put a syscall round-trip on the training hot path every loss_interval steps
+    log_fp = open(args.output_log_file, "w", buffering=1 << 16)
+    log_fp.write("start\n")
+
+    # Loss log lines are queued as async device-to-CPU copies and written out in
+    # batches, so the .item() synchronization is paid once per flush instead of once
+    # per loss_interval.
+    pending_losses = []
+
+    def flush_pending_losses():
+        if not pending_losses:
+            return
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # one sync covers every queued copy
+        for logged_step, avg in pending_losses:
+            log_fp.write(f"\n step :{logged_step} loss: {avg.item()}")
+            print(f"\n step :{logged_step} loss: {avg.item()}")
+        pending_losses.clear()
 
     max_f1 = 0.0
     max_patience, current_patience = 3, 0
@@ -644,36 +787,50 @@ def main():
             break
 
         model.train()
-        epoch_loss = 0
+        # accumulated on device; .item() would force a GPU sync every micro-batch, so the
+        # running sum only crosses to the CPU when a log line is actually written
+        epoch_loss = torch.zeros((), device=accelerator.device)
         epoch_step = 0
 
         for step, batch in enumerate(train_dataloader):
             if if_exit:
                 break
-            outputs = model(**batch)
-            loss = outputs.loss
-            loss = loss / args.gradient_accumulation_steps
-
-            epoch_loss += loss.item()
-            epoch_step += 1
-            accelerator.backward(loss)
-
-            if step % args.gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
-                scheduler.step_and_update_lr()
+            # accumulate() scales the loss and skips the DDP all-reduce on the
+            # non-boundary micro-batches; the old `step % grad_accum == 0` condition
+            # also fired a spurious optimizer step on the very first micro-batch
+            with accelerator.accumulate(model):
+                outputs = model(**batch)
+                loss = outputs.loss
+
+                epoch_loss += loss.detach()
+                epoch_step += 1
+                if args.optimizer_in_backward:
+                    # the hook optimizers consume their LR during backward itself, so
+                    # the scheduler write has to land before the gradients are produced;
+                    # step() on the facade is a no-op, this only advances the LRs
+                    scheduler.step_and_update_lr()
+                accelerator.backward(loss)
+
+            if accelerator.sync_gradients:
+                if not args.optimizer_in_backward:
+                    scheduler.step_and_update_lr()
                 scheduler.zero_grad()
                 progress_bar.update(1)
                 completed_steps += 1
 
             if completed_steps % args.loss_interval == 0:
-                with open(args.output_log_file, "a") as log_file_fr:
-                    log_file_fr.write(f"\n step :{completed_steps} loss: {epoch_loss / epoch_step}")
-                print(f"\n step :{completed_steps} loss: {epoch_loss / epoch_step}")
+                pending_losses.append(
+                    (completed_steps, (epoch_loss / epoch_step).to("cpu", non_blocking=True))
+                )
+                if len(pending_losses) >= 16:
+                    flush_pending_losses()
 
             if args.eval_interval != -1 and completed_steps % args.eval_interval == 0:
+                flush_pending_losses()
                 f = run_eval()
                 if f > max_f1:
                     max_f1 = f
-                    torch.save(model.state_dict(), check_point_folder + f"f1_{max_f1}.pt")
+                    save_checkpoint(check_point_folder + f"f1_{max_f1}.pt")
                     current_patience = 0
                 else:
                     current_patience += 1
@@ -684,20 +841,24 @@ def main():
                 break
 
         if args.eval_interval != -1 and completed_steps % args.eval_interval == 0:
+            flush_pending_losses()
             f = run_eval()
             if f > max_f1:
                 max_f1 = f
-                torch.save(model.state_dict(), check_point_folder + f"f1_{max_f1}.pt")
+                save_checkpoint(check_point_folder + f"f1_{max_f1}.pt")
                 print( check_point_folder + f"f1_{max_f1}.pt")
                 current_patience = 0
             else:
                 current_patience += 1
                 if current_patience > max_patience:
                     if_exit = True
-        with open(args.output_log_file, "a") as log_file_fr:
-            log_file_fr.write(f"epoch {epoch} end \n")
+        flush_pending_losses()
+        log_fp.write(f"epoch {epoch} end \n")
+        log_fp.flush()
         print(f"epoch {epoch} end \n")
 
+    log_fp.close()
+
     if args.output_dir is not None:
         accelerator.wait_for_everyone()
         unwrapped_model = accelerator.unwrap_model(model)
